@@ -1,22 +1,92 @@
-import json
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import logging
 from enum import Enum
+from hashlib import blake2b
 import os
-from fastapi import BackgroundTasks, FastAPI
-from typing import Any, Dict, Literal, Union
+import sys
+from fastapi import BackgroundTasks, FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from typing import Annotated, Any, AsyncIterator, Dict, Literal, Optional, Union
+from uuid import uuid4
+from cachetools import TTLCache
 from linear import LinearClient
+from llm_cache import LLMCache
+from thread_store import SQLiteThreadStore, ThreadStore
 import marvin
+import openai
+from marvin.client import AsyncMarvinClient
+import requests
 
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr, TypeAdapter, ValidationError
+from pydantic_core import from_json, to_json
 from humanlayer import AsyncHumanLayer, FunctionCall, HumanContact
 from humanlayer.core.models import ContactChannel, EmailContactChannel, HumanContactSpec
 from humanlayer.core.models_agent_webhook import EmailMessage, EmailPayload
 
-app = FastAPI(title="HumanLayer FastAPI Email Example", version="1.0.0")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """open llm + linear connections up front so the first webhook doesn't pay for it"""
+    # created per lifespan, so an app that is started again gets a live executor
+    app.state.serde_executor = ThreadPoolExecutor(
+        max_workers=4, thread_name_prefix="thread-serde"
+    )
+    try:
+        if marvin.settings.openai.api_key is None:
+            # marvin raises a plain ValueError building a client without a key
+            logger.warning("no openai api key set, skipping llm warm-up")
+        else:
+            try:
+                await get_marvin_client().client.models.list()
+            except openai.OpenAIError as e:
+                # connection and http errors, openai wraps httpx's own
+                logger.warning(f"could not warm up llm client: {e}")
+        if os.getenv("LINEAR_API_KEY"):
+            try:
+                # also primes the team cache
+                await asyncio.to_thread(get_linear_client().list_all_teams)
+            except requests.RequestException as e:
+                logger.warning(f"could not warm up linear client: {e}")
+        yield
+    finally:
+        app.state.serde_executor.shutdown(wait=False)
+        # later loads fall back to the default executor instead of a dead one
+        app.state.serde_executor = None
+
+
+app = FastAPI(
+    title="HumanLayer FastAPI Email Example", version="1.0.0", lifespan=lifespan
+)
 
 logger = logging.getLogger(__name__)
 
+llm_cache = LLMCache()
+
+# threads waiting on a human. every contact stores its own snapshot and only the
+# snapshot id goes out as state, so concurrent replies on one thread each resume
+# from their own copy. swap in a RedisThreadStore when running on several hosts
+THREAD_STORE: ThreadStore = SQLiteThreadStore(
+    os.getenv("THREAD_STORE_PATH", "threads.sqlite3"),
+    ttl=int(os.getenv("THREAD_STORE_TTL_SECONDS", str(30 * 24 * 60 * 60))),
+)
+
+# upper bound on concurrent llm + linear pipelines, later webhooks wait their turn
+IN_FLIGHT = asyncio.Semaphore(int(os.getenv("MAX_INFLIGHT_THREADS", "32")))
+
+# stored threads with more events than this are validated off the event loop, on
+# the lifespan's serde executor. shorter ones are cheaper to load inline than to
+# hand to a worker. saving stays inline - dumping holds the GIL, so a worker
+# thread wouldn't free the loop
+OFFLOAD_EVENTS_THRESHOLD = 8
+
+# inbound emails already being handled, so redelivered webhooks don't start a
+# second pipeline. entries expire so the map stays bounded
+RECENT_EMAILS: TTLCache = TTLCache(maxsize=10_000, ttl=600)
+
 
 # Root endpoint
 @app.get("/")
@@ -78,9 +148,7 @@ class GetIssuesDueBy(BaseModel):
     due_date: str
 
 
-async def determine_next_step(
-    thread: "Thread",
-) -> Union[
+NextStep = Union[
     ClarificationRequest,
     DraftIssue,
     PublishIssue,
@@ -90,39 +158,41 @@ async def determine_next_step(
     GetUnassignedIssues,
     GetIssuesByLabel,
     GetIssuesDueBy,
-]:
+]
+
+# built once at import: validating cached decisions dispatches on `intent`, and the
+# schema is part of the llm cache key so changing a model invalidates old entries
+NEXT_STEP_ADAPTER: TypeAdapter[NextStep] = TypeAdapter(
+    Annotated[NextStep, Field(discriminator="intent")]
+)
+NEXT_STEP_SCHEMA = NEXT_STEP_ADAPTER.json_schema()
+
+
+INSTRUCTIONS = """
+determine if you have enough information to create an issue, or if you need more input.
+The issue should be a task that needs to be completed.
+
+Once an issue is drafted, a human will automatically review it. If the human approves,
+and has not requested any changes, you should publish it.
+"""
+
+
+@functools.lru_cache(maxsize=1)
+def get_marvin_client() -> AsyncMarvinClient:
+    """process-wide client, so llm calls reuse one openai connection pool"""
+    return AsyncMarvinClient()
+
+
+async def determine_next_step(thread: "Thread") -> NextStep:
     """determine the next step in the email thread"""
 
-    response: Union[
-        ClarificationRequest,
-        DraftIssue,
-        PublishIssue,
-        AssignIssue,
-        GetIssueDetails,
-        GetHighPriorityIssues,
-        GetUnassignedIssues,
-        GetIssuesByLabel,
-        GetIssuesDueBy,
-    ] = await marvin.cast_async(
-        json.dumps([event.model_dump(mode="json") for event in thread.events]),
-        Union[
-            ClarificationRequest,
-            DraftIssue,
-            PublishIssue,
-            AssignIssue,
-            GetIssueDetails,
-            GetHighPriorityIssues,
-            GetUnassignedIssues,
-            GetIssuesByLabel,
-            GetIssuesDueBy,
-        ],
-        instructions="""
-        determine if you have enough information to create an issue, or if you need more input.
-        The issue should be a task that needs to be completed.
-
-        Once an issue is drafted, a human will automatically review it. If the human approves,
-        and has not requested any changes, you should publish it.
-        """,
+    # one JSON line per event, oldest first. marvin joins them into the data
+    # section of its prompt and renders the instructions after it
+    response: NextStep = await marvin.cast_async(
+        thread.serialized_events(),
+        NextStep,
+        instructions=INSTRUCTIONS,
+        client=get_marvin_client(),
     )
     return response
 
@@ -142,15 +212,37 @@ async def publish_issue(issue_id: int) -> None:
 ##########################
 
 
-class Event(BaseModel):
+class EmailReceivedEvent(BaseModel):
+    type: Literal["email_received"] = "email_received"
+    data: EmailPayload
+
+
+class RequestMoreInformationEvent(BaseModel):
+    type: Literal["request_more_information"] = "request_more_information"
+    data: str
+
+
+class DraftIssueEvent(BaseModel):
+    type: Literal["draft_issue"] = "draft_issue"
+    data: DraftIssue
+
+
+class PublishIssueEvent(BaseModel):
+    type: Literal["publish_issue"] = "publish_issue"
+    data: PublishIssue
+
+
+class HumanResponseEvent(BaseModel):
+    type: Literal["human_response"] = "human_response"
+    data: dict[str, Optional[str]]
+
+
+class GenericEvent(BaseModel):
+    """event types nothing emits yet"""
+
     type: Literal[
-        "email_received",
-        "request_more_information",
-        "draft_issue",
         "human_approved__issue_ready_to_publish",
-        "human_response",
         "assign_issue",
-        "publish_issue",
         "get_issue_details",
         "get_high_priority_issues",
         "get_unassigned_issues",
@@ -160,11 +252,29 @@ class Event(BaseModel):
     data: Any  # don't really care about this, it will just be context to the LLM
 
 
+# validation dispatches on `type` with a single lookup instead of trying each model
+Event = Annotated[
+    Union[
+        EmailReceivedEvent,
+        RequestMoreInformationEvent,
+        DraftIssueEvent,
+        PublishIssueEvent,
+        HumanResponseEvent,
+        GenericEvent,
+    ],
+    Field(discriminator="type"),
+]
+EVENT_ADAPTER: TypeAdapter[list[Event]] = TypeAdapter(list[Event])
+
+
 # todo you probably want to version this but for now lets assume we're not going to change the schema
 class Thread(BaseModel):
+    id: str = Field(default_factory=lambda: uuid4().hex)
     initial_email: EmailPayload
     # initial_slack_message: SlackMessage
     events: list[Event]
+    # one JSON string per rendered event, see serialized_events
+    _serialized_events: list[str] = PrivateAttr(default_factory=list)
 
     def to_state(self) -> dict:
         """Convert thread to a state dict for preservation"""
@@ -175,11 +285,82 @@ class Thread(BaseModel):
         """Restore thread from preserved state"""
         return cls.model_validate(state)
 
+    def render_for_llm(self, start: int = 0) -> list[dict]:
+        """Render events from start onwards as JSON-ready dicts, oldest first.
+
+        The initial email is already the first event, so it is not repeated.
+        """
+        return EVENT_ADAPTER.dump_python(self.events[start:], mode="json")
+
+    def serialized_events(self) -> list[str]:
+        """render_for_llm() as one JSON string per event.
+
+        Events are append-only, so only events added since the last call are
+        serialized - everything before that is reused as-is.
+        """
+        done = len(self._serialized_events)
+        self._serialized_events.extend(
+            to_json(event).decode() for event in self.render_for_llm(start=done)
+        )
+        return list(self._serialized_events)
+
+
+async def _hydrate(stored: dict[str, Any]) -> Thread:
+    if len(stored.get("events", [])) <= OFFLOAD_EVENTS_THRESHOLD:
+        return Thread.from_state(stored)
+    return await asyncio.get_running_loop().run_in_executor(
+        # None outside a running lifespan, i.e. the loop's default executor
+        getattr(app.state, "serde_executor", None),
+        Thread.from_state,
+        stored,
+    )
+
+
+async def save_thread(thread: Thread) -> dict:
+    """store a snapshot of the thread, returning the state for a humanlayer call"""
+    snapshot_id = uuid4().hex
+    await THREAD_STORE.set(snapshot_id, thread.to_state())
+    return {"thread_id": thread.id, "snapshot_id": snapshot_id}
+
+
+async def load_thread(state: dict) -> Optional[Thread]:
+    """hydrate the thread referenced by state returned on a humanlayer webhook.
+
+    Returns None if the snapshot is gone (expired, or never stored here).
+    """
+    stored: Optional[dict[str, Any]]
+    if "events" in state:
+        # contacts created before threads were stored carry the whole thread
+        stored = state
+    else:
+        stored = await THREAD_STORE.get(state.get("snapshot_id", ""))
+        if stored is None:
+            return None
+    return await _hydrate(stored)
+
 
 ##########################
 ######## Handlers ########
 ##########################
+@functools.lru_cache(maxsize=4)
+def _linear_client_for(api_key: str) -> LinearClient:
+    return LinearClient(api_key=api_key)
+
+
+def get_linear_client() -> LinearClient:
+    """shared client per api key, so its session keeps connections to linear open"""
+    api_key = os.getenv("LINEAR_API_KEY")
+    if not api_key:
+        raise ValueError("LINEAR_API_KEY is not set")
+    return _linear_client_for(api_key)
+
+
 async def handle_continued_thread(thread: Thread) -> None:
+    async with IN_FLIGHT:
+        await _handle_continued_thread(thread)
+
+
+async def _handle_continued_thread(thread: Thread) -> None:
     humanlayer = AsyncHumanLayer(
         contact_channel=ContactChannel(email=thread.initial_email.as_channel())
     )
@@ -190,45 +371,63 @@ async def handle_continued_thread(thread: Thread) -> None:
     logger.info(
         f"thread received, determining next step. Last event: {thread.events[-1].type}"
     )
-    next_step = await determine_next_step(thread)
-    logger.info(f"next step: {next_step.intent}")
+    events = thread.serialized_events()
+    cache_key = llm_cache.cache_key(
+        marvin.settings.openai.chat.completions.model,
+        events,
+        NEXT_STEP_SCHEMA,
+        INSTRUCTIONS,
+    )
+    cached = await llm_cache.get(cache_key)
+    if cached is not None:
+        next_step = NEXT_STEP_ADAPTER.validate_python(cached)
+    else:
+        next_step = await determine_next_step(thread)
+        await llm_cache.set(cache_key, next_step.model_dump(mode="json"))
+    logger.info(
+        f"next step: {next_step.intent} "
+        f"(llm cache hits={llm_cache.stats.hits} misses={llm_cache.stats.misses})"
+    )
 
     if next_step.intent == "request_more_information":
         logger.info(f"requesting more information: {next_step.message}")
-        thread.events.append(
-            Event(type="request_more_information", data=next_step.message)
-        )
+        thread.events.append(RequestMoreInformationEvent(data=next_step.message))
         await humanlayer.create_human_contact(
-            spec=HumanContactSpec(msg=next_step.message, state=thread.to_state())
+            spec=HumanContactSpec(
+                msg=next_step.message, state=await save_thread(thread)
+            )
         )
 
     elif next_step.intent == "ready_to_draft_issue":
-        logger.info(f"drafted issue: {next_step.model_dump_json()}")
-        thread.events.append(Event(type="draft_issue", data=next_step))
+        logger.info(f"drafted issue: {next_step.title}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"drafted issue: {next_step.model_dump_json()}")
+        thread.events.append(DraftIssueEvent(data=next_step))
         await humanlayer.create_human_contact(
             spec=HumanContactSpec(
                 msg=f"I've drafted an issue with title: {next_step.title} with description: {next_step.description}. Would you like me to publish it?",
-                state=thread.to_state(),
+                state=await save_thread(thread),
             )
         )
 
     elif next_step.intent == "human_approved__issue_ready_to_publish":
-        logger.info(f"publishing issue: {next_step.model_dump_json()}")
-        LINEAR_API_KEY = os.environ["LINEAR_API_KEY"]
-        if not LINEAR_API_KEY:
-            raise ValueError("LINEAR_API_KEY is not set")
-        client = LinearClient(api_key=LINEAR_API_KEY)
-        client.create_issue(
+        logger.info(f"publishing issue: {next_step.title}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"publishing issue: {next_step.model_dump_json()}")
+        client = get_linear_client()
+        # the linear client is blocking, keep it off the event loop
+        await asyncio.to_thread(
+            client.create_issue,
             title=next_step.title,
             description=next_step.description,
             team_id=next_step.team_id,
         )
-        thread.events.append(Event(type="publish_issue", data=next_step))
+        thread.events.append(PublishIssueEvent(data=next_step))
 
         await humanlayer.create_human_contact(
             spec=HumanContactSpec(
                 msg="Issue has been published. Let me know if you need anything else!",
-                state=thread.to_state(),
+                state=await save_thread(thread),
             )
         )
 
@@ -237,26 +436,114 @@ async def handle_continued_thread(thread: Thread) -> None:
     logger.info(f"thread sent to humanlayer. Last event: {thread.events[-1].type}")
 
 
-@app.post("/webhook/new-email-thread")
+def email_key(email: EmailPayload) -> str:
+    if email.message_id:
+        return email.message_id
+    content = f"{email.from_address}\n{email.subject}\n{email.body}"
+    return blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+async def handle_new_thread(key: str, thread: Thread) -> None:
+    try:
+        await handle_continued_thread(thread)
+    except Exception:
+        # let the next delivery of this email try again
+        RECENT_EMAILS.pop(key, None)
+        raise
+
+
+# the route reads the raw body itself, so document the payload it expects by hand.
+# nested models go under components, where the refs in the schema point
+_EMAIL_PAYLOAD_SCHEMA = EmailPayload.model_json_schema(
+    ref_template="#/components/schemas/{model}"
+)
+_EMAIL_PAYLOAD_COMPONENTS = {
+    **_EMAIL_PAYLOAD_SCHEMA.pop("$defs", {}),
+    EmailPayload.__name__: _EMAIL_PAYLOAD_SCHEMA,
+}
+_default_openapi = app.openapi
+# coerces is_test the way EmailPayload would, so "false" isn't taken as truthy
+_IS_TEST_ADAPTER: TypeAdapter[Optional[bool]] = TypeAdapter(Optional[bool])
+
+
+def _openapi() -> Dict[str, Any]:
+    if app.openapi_schema is not None:
+        return app.openapi_schema
+    schema = _default_openapi()
+    components = schema.setdefault("components", {})
+    components.setdefault("schemas", {}).update(_EMAIL_PAYLOAD_COMPONENTS)
+    return schema
+
+
+app.openapi = _openapi  # type: ignore[method-assign]
+
+
+def _is_test(value: Any) -> bool:
+    try:
+        return _IS_TEST_ADAPTER.validate_python(value) is True
+    except ValidationError:
+        # left for EmailPayload validation to reject
+        return False
+
+
+@app.post(
+    "/webhook/new-email-thread",
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {"$ref": f"#/components/schemas/{EmailPayload.__name__}"}
+                }
+            },
+            "required": True,
+        }
+    },
+)
 async def email_inbound(
-    email_payload: EmailPayload, background_tasks: BackgroundTasks
+    request: Request, background_tasks: BackgroundTasks
 ) -> Dict[str, Any]:
     """
     route to kick off new processing thread from an email
     """
-    # test payload
-    if (
-        email_payload.is_test
-        or email_payload.from_address == "overworked-admin@coolcompany.com"
+    try:
+        raw = from_json(await request.body())
+    except ValueError as e:
+        raise RequestValidationError(
+            [{"type": "json_invalid", "loc": ("body",), "msg": str(e)}]
+        )
+
+    # test payload - checked on the raw json so test pings skip EmailPayload parsing
+    if isinstance(raw, dict) and (
+        _is_test(raw.get("is_test"))
+        or raw.get("from_address") == "overworked-admin@coolcompany.com"
     ):
         logger.info("test payload received, skipping")
         return {"status": "ok"}
 
-    logger.info(f"inbound email received: {email_payload.model_dump_json()}")
+    try:
+        email_payload = EmailPayload.model_validate(raw)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors()]
+        )
+
+    key = email_key(email_payload)
+    if key in RECENT_EMAILS:
+        logger.info(f"duplicate delivery of {key}, skipping")
+        return {"status": "deduplicated"}
+    RECENT_EMAILS[key] = True
+
+    logger.info(
+        f"inbound email received from {email_payload.from_address}: "
+        f"{email_payload.subject!r} ({len(email_payload.body)} chars)"
+    )
+    # the full payload includes the raw email, only build it if it will be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"inbound email payload: {email_payload.model_dump_json()}")
     thread = Thread(initial_email=email_payload, events=[])
-    thread.events.append(Event(type="email_received", data=email_payload))
+    thread.events.append(EmailReceivedEvent(data=email_payload))
 
-    background_tasks.add_task(handle_continued_thread, thread)
+    background_tasks.add_task(handle_new_thread, key, thread)
 
     return {"status": "ok"}
 
@@ -270,17 +557,20 @@ async def human_response(
     """
 
     if human_response.spec.state is not None:
-        thread = Thread.model_validate(human_response.spec.state)
+        thread = await load_thread(human_response.spec.state)
+        if thread is None:
+            # retrying won't bring the thread back, so acknowledge and move on
+            logger.warning(
+                f"no stored thread for state {human_response.spec.state}, skipping"
+            )
+            return {"status": "unknown_thread"}
     else:
         # decide what's the right way to handle this? probably logger.warn and proceed
         raise ValueError("state is required")
 
     if isinstance(human_response, HumanContact):
         thread.events.append(
-            Event(
-                type="human_response",
-                data={"human_response": human_response.status.response},
-            )
+            HumanResponseEvent(data={"human_response": human_response.status.response})
         )
         background_tasks.add_task(handle_continued_thread, thread)
 
@@ -288,12 +578,37 @@ async def human_response(
 
 
 if __name__ == "__main__":
-    import uvicorn
+    import copy
 
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
+    import uvicorn
+    from uvicorn.config import LOGGING_CONFIG
+
+    # uvicorn applies log_config in every worker process, which never run this
+    # block - so app logging is set up here rather than with logging.basicConfig
+    log_config = copy.deepcopy(LOGGING_CONFIG)
+    log_config["formatters"]["app"] = {
+        "format": "%(asctime)s - %(levelname)s - %(message)s",
+        "datefmt": "%Y-%m-%d %H:%M:%S",
+    }
+    log_config["handlers"]["app"] = {
+        "formatter": "app",
+        "class": "logging.StreamHandler",
+        "stream": "ext://sys.stderr",
+    }
+    log_config["root"] = {"handlers": ["app"], "level": "INFO"}
+
+    # workers share THREAD_STORE through its sqlite file, but llm_cache, the
+    # RECENT_EMAILS dedupe and the IN_FLIGHT limit are per worker - a redelivered
+    # email that lands on another worker is handled again. give llm_cache a
+    # RedisBackend and move dedupe somewhere shared before raising
+    # WEB_CONCURRENCY above 1
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "app:app" if workers > 1 else app,
+        host="0.0.0.0",  # noqa: S104
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=workers,
+        log_config=log_config,
     )
-
-    uvicorn.run(app, host="0.0.0.0", port=8000)  # noqa: S104
@@ -1,5 +1,28 @@
+import functools
+import json
+import threading
 from typing import Dict, Optional, Any
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+
+# teams change on the scale of days, so team lookups are shared across clients
+# (keyed by api key) and only refreshed every few minutes
+_TEAMS_CACHE: TTLCache = TTLCache(maxsize=8, ttl=300)
+_TEAMS_CACHE_LOCK = threading.Lock()
+
+
+def _teams_cache_key(name: str, api_key: str) -> tuple:
+    """Key of the team lookup `name` for one api key in _TEAMS_CACHE."""
+    return hashkey(name, api_key)
+
+
+@functools.lru_cache(maxsize=32)
+def _encode_query(query: str) -> bytes:
+    """Request body for a query without variables, encoded once per query."""
+    return json.dumps({"query": query}).encode()
 
 
 class LinearClient:
@@ -18,6 +41,17 @@ class LinearClient:
         self.session.headers.update(
             {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
         )
+        # keep connections to the API warm across calls. every call is a POST,
+        # which urllib3 only retries when the connection itself fails - the
+        # request was never sent, so a mutation can't be applied twice
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=10,
+                pool_maxsize=50,
+                max_retries=Retry(total=3, backoff_factor=0.2),
+            ),
+        )
 
     def _make_request(
         self, query: str, variables: Optional[Dict[str, Any]] = None
@@ -34,11 +68,11 @@ class LinearClient:
         Raises:
             requests.exceptions.RequestException: If the request fails
         """
-        payload = {"query": query}
         if variables:
-            payload["variables"] = variables
-
-        response = self.session.post(self.BASE_URL, json=payload)
+            payload = {"query": query, "variables": variables}
+            response = self.session.post(self.BASE_URL, json=payload)
+        else:
+            response = self.session.post(self.BASE_URL, data=_encode_query(query))
         response.raise_for_status()
         return response.json()
 
@@ -83,6 +117,11 @@ class LinearClient:
         """
         return self._make_request(query, variables={"issueId": issue_id})
 
+    @cached(
+        _TEAMS_CACHE,
+        key=lambda self: _teams_cache_key("list_all_teams", self.api_key),
+        lock=_TEAMS_CACHE_LOCK,
+    )
     def list_all_teams(self) -> Dict[str, Any]:
         """List all teams and their members."""
         query = """
@@ -104,6 +143,11 @@ class LinearClient:
         """
         return self._make_request(query)
 
+    @cached(
+        _TEAMS_CACHE,
+        key=lambda self: _teams_cache_key("get_default_team_id", self.api_key),
+        lock=_TEAMS_CACHE_LOCK,
+    )
     def get_default_team_id(self) -> str:
         """Get the ID of the most recently created team."""
         query = """
@@ -120,6 +164,12 @@ class LinearClient:
         response = self._make_request(query)
         return response["data"]["teams"]["nodes"][0]["id"]
 
+    def clear_team_cache(self) -> None:
+        """Drop cached team lookups for this api key, e.g. after creating a team."""
+        with _TEAMS_CACHE_LOCK:
+            for name in ("list_all_teams", "get_default_team_id"):
+                _TEAMS_CACHE.pop(_teams_cache_key(name, self.api_key), None)
+
     def list_all_issues(self, from_time: str, to_time: str) -> Dict[str, Any]:
         """List all issues created within a time window."""
         query = """
@@ -143,6 +193,52 @@ class LinearClient:
             query, variables={"from_time": from_time, "to_time": to_time}
         )
 
+    def list_issues_and_teams(self, from_time: str, to_time: str) -> Dict[str, Any]:
+        """List issues created within a time window and all teams in one request.
+
+        The teams half also refreshes the cache behind list_all_teams.
+        """
+        query = """
+        query IssuesAndTeams($from_time: DateTime!, $to_time: DateTime!) {
+            issues(
+                filter: { createdAt: { gte: $from_time, lte: $to_time } }
+                orderBy: { createdAt: ASC }
+            ) {
+                nodes {
+                    id
+                    title
+                    description
+                    url
+                    createdAt
+                    assignee { name }
+                }
+            }
+            teams {
+                nodes {
+                    id
+                    name
+                    members {
+                        nodes {
+                            email
+                            id
+                            displayName
+                        }
+                    }
+                }
+            }
+        }
+        """
+        response = self._make_request(
+            query, variables={"from_time": from_time, "to_time": to_time}
+        )
+        teams = (response.get("data") or {}).get("teams")
+        if teams is not None:
+            with _TEAMS_CACHE_LOCK:
+                _TEAMS_CACHE[_teams_cache_key("list_all_teams", self.api_key)] = {
+                    "data": {"teams": teams}
+                }
+        return response
+
     def create_issue(
         self, title: str, description: str, team_id: Optional[str] = None
     ) -> Dict[str, Any]:
@@ -0,0 +1,123 @@
+import hashlib
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Optional, Protocol
+
+from pydantic_core import from_json, to_json
+
+
+class CacheBackend(Protocol):
+    """Key/value storage used by LLMCache. Values must be JSON-serializable."""
+
+    async def get(self, key: str) -> Optional[Any]: ...
+
+    async def set(self, key: str, value: Any) -> None: ...
+
+
+class InMemoryBackend:
+    """Process-local backend. Evicts least recently used entries past maxsize."""
+
+    def __init__(self, maxsize: Optional[int] = None):
+        """Initialize the backend.
+
+        Args:
+            maxsize: Maximum number of entries to keep, or None for unbounded
+        """
+        self.maxsize = maxsize
+        self._data: OrderedDict[str, Any] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    async def set(self, key: str, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class RedisBackend:
+    """Backend shared across workers, e.g. `redis.asyncio.Redis.from_url(...)`."""
+
+    def __init__(
+        self, client: Any, prefix: str = "llm-cache:", ttl: Optional[int] = None
+    ):
+        """Initialize the backend.
+
+        Args:
+            client: A `redis.asyncio.Redis` (or compatible) client
+            prefix: Prefix prepended to every key
+            ttl: Optional expiry for entries, in seconds
+        """
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[Any]:
+        raw = await self.client.get(self.prefix + key)
+        return None if raw is None else from_json(raw)
+
+    async def set(self, key: str, value: Any) -> None:
+        await self.client.set(self.prefix + key, to_json(value), ex=self.ttl)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+
+class LLMCache:
+    """Exact-match cache for LLM responses, keyed by a hash of the request."""
+
+    def __init__(self, backend: Optional[CacheBackend] = None):
+        """Initialize the cache.
+
+        Args:
+            backend: Where to store responses. Defaults to a bounded in-memory backend
+        """
+        self.backend = backend if backend is not None else InMemoryBackend(maxsize=1024)
+        self.stats = CacheStats()
+
+    @staticmethod
+    def cache_key(
+        model: str,
+        messages: list[Any],
+        tools: Optional[Any] = None,
+        instructions: Optional[str] = None,
+    ) -> str:
+        """Build a stable key from everything that determines the LLM response.
+
+        Args:
+            model: Name of the model or LLM function being called
+            messages: JSON-serializable prompt contents
+            tools: Optional JSON-serializable tool / response schema
+            instructions: Optional prompt text sent alongside the messages
+
+        Returns:
+            Hex SHA-256 digest of the canonicalized request
+        """
+        payload = {
+            "model": model,
+            "messages": messages,
+            "tools": tools,
+            "instructions": instructions,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Return the cached response for key, or None on a miss."""
+        value = await self.backend.get(key)
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        """Store a JSON-serializable response under key."""
+        await self.backend.set(key, value)
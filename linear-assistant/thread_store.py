@@ -0,0 +1,104 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import Any, Optional, Protocol
+
+from pydantic_core import from_json, to_json
+
+
+class ThreadStore(Protocol):
+    """Where threads wait for a human reply. States are JSON-serializable dicts."""
+
+    async def get(self, key: str) -> Optional[dict]: ...
+
+    async def set(self, key: str, state: dict) -> None: ...
+
+
+class SQLiteThreadStore:
+    """Durable store in a local SQLite file, shared by every worker on the host."""
+
+    def __init__(self, path: str, ttl: Optional[int] = None):
+        """Initialize the store. The database is created on first use.
+
+        Args:
+            path: Path of the SQLite database file
+            ttl: Optional expiry for entries, in seconds
+        """
+        self.path = path
+        self.ttl = ttl
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        with self._schema_lock:
+            if not self._schema_ready:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS threads"
+                    " (key TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL)"
+                )
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS threads_expires_at"
+                    " ON threads (expires_at)"
+                )
+                self._schema_ready = True
+        return conn
+
+    def _get_sync(self, key: str) -> Optional[dict]:
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT state FROM threads"
+                " WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        finally:
+            conn.close()
+        return None if row is None else from_json(row[0])
+
+    def _set_sync(self, key: str, state: dict) -> None:
+        now = time.time()
+        expires_at = None if self.ttl is None else now + self.ttl
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO threads (key, state, expires_at)"
+                    " VALUES (?, ?, ?)",
+                    (key, to_json(state).decode(), expires_at),
+                )
+                # expired entries are dropped as new ones arrive
+                conn.execute("DELETE FROM threads WHERE expires_at <= ?", (now,))
+        finally:
+            conn.close()
+
+    async def get(self, key: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._get_sync, key)
+
+    async def set(self, key: str, state: dict) -> None:
+        await asyncio.to_thread(self._set_sync, key, state)
+
+
+class RedisThreadStore:
+    """Store shared across hosts, e.g. `redis.asyncio.Redis.from_url(...)`."""
+
+    def __init__(self, client: Any, prefix: str = "thread:", ttl: Optional[int] = None):
+        """Initialize the store.
+
+        Args:
+            client: A `redis.asyncio.Redis` (or compatible) client
+            prefix: Prefix prepended to every key
+            ttl: Optional expiry for entries, in seconds
+        """
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[dict]:
+        raw = await self.client.get(self.prefix + key)
+        return None if raw is None else from_json(raw)
+
+    async def set(self, key: str, state: dict) -> None:
+        await self.client.set(self.prefix + key, to_json(state), ex=self.ttl)